@@ -68,10 +68,12 @@ masker.fit()
 #   to score our predictions
 #
 
-source_train = df[df.subject == 'sub-01'][df.acquisition == 'ap'].path.values
-target_train = df[df.subject == 'sub-02'][df.acquisition == 'ap'].path.values
-source_test = df[df.subject == 'sub-01'][df.acquisition == 'pa'].path.values
-target_test = df[df.subject == 'sub-02'][df.acquisition == 'pa'].path.values
+sub_01, sub_02 = df.subject == 'sub-01', df.subject == 'sub-02'
+ap, pa = df.acquisition == 'ap', df.acquisition == 'pa'
+source_train = df.loc[sub_01 & ap, 'path'].values
+target_train = df.loc[sub_02 & ap, 'path'].values
+source_test = df.loc[sub_01 & pa, 'path'].values
+target_test = df.loc[sub_02 & pa, 'path'].values
 
 #############################################################################
 # Define the estimator used to align subjects, fit it and use it to predict
@@ -37,19 +37,36 @@ files, df, mask = fetch_ibc_subjects_contrasts(
 ###############################################################################
 # Extract a mask for the visual cortex from Yeo Atlas
 # -----------------
-# First, we fetch and plot the complete atlas
+# First, we fetch the complete atlas, select the visual cortex and resample
+# it to the resolution of our data. As those inputs never change, the result
+# is cached on disk with joblib so that later runs of this example skip it.
 #
 
+import os
+import numpy as np
+from joblib import Memory
 from nilearn import datasets
 from nilearn.plotting import plot_roi
-from nilearn.image import resample_to_img, load_img, new_img_like
-atlas_yeo_2011 = datasets.fetch_atlas_yeo_2011()
-atlas_yeo = atlas_yeo_2011.thick_7
-atlas = load_img(atlas_yeo)
-# Select visual cortex, create a mask and resample it to the right resolution
-mask_visual = new_img_like(atlas, atlas.get_data() == 1)
-resampled_mask_visual = resample_to_img(
-    mask_visual, mask, interpolation="nearest")
+from nilearn.image import resample_img, load_img, new_img_like
+memory = Memory(os.path.expanduser('~/.cache/fmralign'), verbose=0)
+
+
+@memory.cache
+def get_resampled_yeo_visual(target_affine, target_shape):
+    """Visual network of Yeo atlas, resampled on the given grid"""
+    atlas_yeo_2011 = datasets.fetch_atlas_yeo_2011()
+    atlas_yeo = atlas_yeo_2011.thick_7
+    atlas = load_img(atlas_yeo)
+    # Select visual cortex, create a mask and resample it to the right
+    # resolution
+    mask_visual = new_img_like(atlas, np.asanyarray(atlas.dataobj) == 1)
+    return resample_img(mask_visual, target_affine=target_affine,
+                        target_shape=target_shape, interpolation="nearest")
+
+
+mask_img = load_img(mask)
+resampled_mask_visual = get_resampled_yeo_visual(mask_img.affine,
+                                                 mask_img.shape[:3])
 
 # Plot the mask we will use
 plot_roi(resampled_mask_visual, title='Visual mask extracted from atlas',
@@ -66,6 +83,16 @@ from nilearn.input_data import NiftiMasker
 roi_masker = NiftiMasker(mask_img=resampled_mask_visual)
 roi_masker.fit()
 
+# Each file can be loaded and masked independently, so we spread lists of
+# files over threads and stack the masked data
+from joblib import Parallel, delayed
+
+
+def mask_files(masker, files):
+    """Mask each file of a list in parallel and stack the results"""
+    return np.vstack(Parallel(n_jobs=-1, prefer='threads')(
+        delayed(masker.transform_single_imgs)(f) for f in files))
+
 ###############################################################################
 # Separate the retrieved files into four folds
 # ---------------------------------------------
@@ -88,10 +115,12 @@ roi_masker.fit()
 # * target test: PA contrasts for subject two, used as a ground truth
 #   to score our predictions
 #
-source_train = df[df.subject == 'sub-01'][df.acquisition == 'ap'].path.values
-target_train = df[df.subject == 'sub-02'][df.acquisition == 'ap'].path.values
-source_test = df[df.subject == 'sub-01'][df.acquisition == 'pa'].path.values
-target_test = df[df.subject == 'sub-02'][df.acquisition == 'pa'].path.values
+sub_01, sub_02 = df.subject == 'sub-01', df.subject == 'sub-02'
+ap, pa = df.acquisition == 'ap', df.acquisition == 'pa'
+source_train = df.loc[sub_01 & ap, 'path'].values
+target_train = df.loc[sub_02 & ap, 'path'].values
+source_test = df.loc[sub_01 & pa, 'path'].values
+target_test = df.loc[sub_02 & pa, 'path'].values
 
 #############################################################################
 # Define the estimator used to align subjects, fit it and use it to predict
@@ -101,15 +130,32 @@ target_test = df[df.subject == 'sub-02'][df.acquisition == 'pa'].path.values
 # We use the scaled orthogonal method, common in the literature under the \
 # name hyperalignment. As we work on a single ROI, we will search correspondence \
 # between the full data of each subject and so we set the number of cluster \
-# n_pieces to 1. We learn alignment estimator on train data and use it \
-# to predict target test data
+# n_pieces to 1. We learn alignment estimator on train data and use it \
+# to predict target test data. As training data and mask do not change from \
+# one run of this example to the other, the fit is cached on disk. The cache \
+# is keyed on the estimator, the train files and the fmralign version, so \
+# that the estimator is refitted when any of them changes.
 #
 
+from fmralign.version import __version__ as fmralign_version
 from fmralign.pairwise_alignment import PairwiseAlignment
 alignment_estimator = PairwiseAlignment(
     alignment_method='scaled_orthogonal', n_pieces=1, mask=roi_masker)
-alignment_estimator.fit(source_train, target_train)
-predicted_img = alignment_estimator.transform(source_test)
+
+
+def fit_alignment(estimator, source_train, target_train, fmralign_version):
+    """Fit estimator on train data, fmralign_version only keys the cache"""
+    return estimator.fit(source_train, target_train)
+
+
+alignment_estimator = memory.cache(fit_alignment)(
+    alignment_estimator, tuple(source_train), tuple(target_train),
+    fmralign_version)
+# Mask the source test data once: it is used both for prediction and scoring.
+# The prediction is only used for scoring, so we keep it masked as well.
+source_test_masked = mask_files(roi_masker, source_test)
+predicted_masked = alignment_estimator.transform(
+    source_test_masked, already_masked=True, return_masked=True)
 
 #############################################################################
 # Score the prediction of test data with and without alignment
@@ -119,19 +165,22 @@ predicted_img = alignment_estimator.transform(source_test)
 # This score is 1 for a perfect prediction and can get \
 #   arbitrarly bad (here we clip it to -1 for bad predictions)
 
-import numpy as np
-from sklearn.metrics import r2_score
+
+def r2_raw(y_true, y_pred):
+    """r2 score of each voxel, clipped to -1"""
+    ss_res = ((y_true - y_pred) ** 2).sum(axis=0)
+    ss_tot = ((y_true - y_true.mean(axis=0)) ** 2).sum(axis=0)
+    score = 1 - ss_res / np.where(ss_tot == 0, 1, ss_tot)
+    return np.clip(score, -1, None, out=score)
+
+
 # Mask the real test data for subject 2 to get a ground truth vector
-ground_truth = roi_masker.transform(target_test)
+ground_truth = mask_files(roi_masker, target_test)
 
 # Score the prediction of test data without alignment...
-baseline_score = np.maximum(
-    r2_score(ground_truth, roi_masker.transform(source_test),
-             multioutput='raw_values'), -1)
+baseline_score = r2_raw(ground_truth, source_test_masked)
 # ... and using alignment.
-aligned_score = np.maximum(
-    r2_score(ground_truth, roi_masker.transform(predicted_img),
-             multioutput='raw_values'), -1)
+aligned_score = r2_raw(ground_truth, predicted_masked)
 #############################################################################
 # Plotting the prediction quality
 # --------------------------------
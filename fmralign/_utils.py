@@ -46,9 +46,11 @@ def piecewise_transform(labels, estimators, X):
         Transformed data
     """
 
-    X_transform = np.zeros_like(X)
+    # every feature belongs to a piece, so all rows get written
+    X_transform = np.empty_like(X)
     for i in np.unique(labels):
-        X_transform[labels == i] = estimators[i].transform(X[labels == i].T).T
+        piece = labels == i
+        X_transform[piece] = estimators[i].transform(X[piece].T).T
     return X_transform
 
 
@@ -2,6 +2,7 @@ import numpy as np
 import scipy
 from scipy.spatial.distance import cdist
 from scipy import linalg
+from scipy.linalg.lapack import get_lapack_funcs, _compute_lwork
 from scipy.sparse import diags
 from sklearn.base import BaseEstimator, TransformerMixin
 from sklearn.utils.linear_assignment_ import linear_assignment
@@ -10,6 +11,95 @@ from sklearn.linear_model import RidgeCV
 from joblib import Parallel, delayed
 
 
+# LAPACK gesdd handles and workspace sizes, memoized by (shape, dtype) since
+# the same matrix shapes are decomposed over and over across pieces
+_GESDD_CACHE = {}
+
+
+def _svd(A, overwrite_a=False):
+    """Thin SVD of A through a direct call to LAPACK gesdd
+
+    Parameters
+    ----------
+    A: (m, n) nd array
+        matrix to decompose
+    overwrite_a: bool, optional
+        Whether A may be used as workspace (its content is then destroyed)
+
+    Returns
+    ----------
+    U: (m, k) nd array
+        left singular vectors, with k = min(m, n)
+    s: (k) nd array
+        singular values, in decreasing order
+    V: (k, n) nd array
+        right singular vectors (transposed)
+    """
+    key = (A.shape, A.dtype)
+    if key not in _GESDD_CACHE:
+        gesdd, gesdd_lwork = get_lapack_funcs(('gesdd', 'gesdd_lwork'), (A,))
+        lwork = _compute_lwork(gesdd_lwork, A.shape[0], A.shape[1],
+                               compute_uv=1, full_matrices=0)
+        _GESDD_CACHE[key] = gesdd, lwork
+    gesdd, lwork = _GESDD_CACHE[key]
+    U, s, V, info = gesdd(A, compute_uv=1, full_matrices=0, lwork=lwork,
+                          overwrite_a=overwrite_a)
+    if info > 0:
+        raise linalg.LinAlgError("SVD did not converge")
+    if info < 0:
+        raise ValueError("illegal value in %d-th argument of internal gesdd"
+                         % -info)
+    return U, s, V
+
+
+def _prepare_procrustes(X, Y, scaling=False):
+    """Cast X and Y to the working precision of scaled_procrustes, check that
+    they are finite and solve the cases which need no SVD.
+
+    Returns
+    ----------
+    X, Y: (n_samples, n_features) nd arrays
+        X and Y in working precision
+    x_norm: float
+        Frobenius norm of X
+    solution: (R, sc) tuple or None
+        Solution of scaled_procrustes if X or Y is null or if Y is
+        proportional to X, None otherwise
+    """
+    dtype = np.result_type(X.dtype, Y.dtype, np.float32)
+    X = X.astype(dtype, copy=False)
+    Y = Y.astype(dtype, copy=False)
+    # _svd does not check its input, and LAPACK may hang on infs or NaNs
+    if not (np.isfinite(X).all() and np.isfinite(Y).all()):
+        raise ValueError("array must not contain infs or NaNs")
+    # norms are accumulated in double precision, to keep the
+    # proportionality test below within a few eps of float32 inputs
+    x_norm = np.sqrt(np.einsum('ij,ij->', X, X, dtype=np.float64))
+    y_norm = np.sqrt(np.einsum('ij,ij->', Y, Y, dtype=np.float64))
+    if x_norm == 0 or y_norm == 0:
+        return X, Y, x_norm, (np.eye(X.shape[1], dtype=dtype), 1)
+    # With fewer samples than features, the solution is a partial isometry
+    # of rank n_samples even if Y is proportional to X: only tall inputs
+    # have the identity as solution
+    if X.shape[0] >= X.shape[1]:
+        residual = Y - dtype.type(y_norm / x_norm) * X
+        if np.einsum('ij,ij->', residual, residual, dtype=np.float64) <= \
+                (10 * np.finfo(dtype).eps * y_norm) ** 2:
+            # Y is proportional to X: the identity is optimal, no SVD needed
+            sc = float(y_norm / x_norm) if scaling else 1
+            return X, Y, x_norm, (np.eye(X.shape[1], dtype=dtype), sc)
+    return X, Y, x_norm, None
+
+
+def _procrustes_scale(s, x_norm, scaling=False):
+    """Scaling parameter of scaled_procrustes from the singular values s of
+    Y^TX and the Frobenius norm of X"""
+    if scaling:
+        # a Python float keeps sc * R in the precision of R
+        return float(s.sum() / (x_norm ** 2))
+    return 1
+
+
 def scaled_procrustes(X, Y, scaling=False, primal=None):
     """Compute a mixing matrix R and a scaling sc such that Frobenius norm
     ||sc RX - Y||^2 is minimized and R is an orthogonal matrix.
@@ -19,7 +109,8 @@ def scaled_procrustes(X, Y, scaling=False, primal=None):
     X: (n_samples, n_features) nd array
         source data
     Y: (n_samples, n_features) nd array
-        target data
+        target data. Computations are done in single precision if X and Y
+        are both float32 arrays, in double precision otherwise.
     scaling: bool
         If scaling is true, computes a floating scaling parameter sc such that:
         ||sc * RX - Y||^2 is minimized and
@@ -27,8 +118,9 @@ def scaled_procrustes(X, Y, scaling=False, primal=None):
         - sc is a scalar
         If scaling is false sc is set to 1
     primal: bool or None, optional,
-         Whether the SVD is done on the YX^T (primal) or Y^TX (dual)
-         if None primal is used iff n_features <= n_timeframes
+         Whether the SVD is done on the (n_features, n_features) matrix Y^TX
+         (primal) or on a (n_samples, n_samples) reduction of it (dual)
+         if None primal is used iff n_features <= n_samples
 
     Returns
     ----------
@@ -37,30 +129,71 @@ def scaled_procrustes(X, Y, scaling=False, primal=None):
     sc: int
         scaling parameter
     """
-    X = X.astype(np.float64, copy=False)
-    Y = Y.astype(np.float64, copy=False)
-    if np.linalg.norm(X) == 0 or np.linalg.norm(Y) == 0:
-        return diags(np.ones(X.shape[1])).tocsr(), 1
+    X, Y, x_norm, solution = _prepare_procrustes(X, Y, scaling)
+    if solution is not None:
+        return solution
     if primal is None:
         primal = X.shape[0] >= X.shape[1]
     if primal:
         A = Y.T.dot(X)
         if A.shape[0] == A.shape[1]:
             A += + 1.e-18 * np.eye(A.shape[0])
-        U, s, V = linalg.svd(A, full_matrices=0)
+        U, s, V = _svd(A, overwrite_a=True)
         R = U.dot(V)
     else:  # "dual" mode
-        Uy, sy, Vy = linalg.svd(Y, full_matrices=0)
-        Ux, sx, Vx = linalg.svd(X, full_matrices=0)
-        A = np.diag(sy).dot(Uy.T).dot(Ux).dot(np.diag(sx))
-        U, s, V = linalg.svd(A)
+        Uy, sy, Vy = _svd(Y)
+        Ux, sx, Vx = _svd(X)
+        A = (sy[:, np.newaxis] * Uy.T.dot(Ux)) * sx
+        U, s, V = _svd(A, overwrite_a=True)
         R = Vy.T.dot(U).dot(V).dot(Vx)
 
-    if scaling:
-        sc = s.sum() / (np.linalg.norm(X) ** 2)
-    else:
-        sc = 1
-    return R.T, sc
+    return R.T, _procrustes_scale(s, x_norm, scaling)
+
+
+def scaled_procrustes_batch(Xs, Ys, scaling=False):
+    """Compute scaled_procrustes(X, Y) for lists Xs, Ys of arrays sharing the
+    same (n_samples, n_features) shape, with n_samples >= n_features. Pairs
+    needing an SVD are stacked and decomposed in a single batched LAPACK
+    call, which only pays off over one call per pair on small pieces
+    (about 10 features or less).
+
+    Parameters
+    ----------
+    Xs: list of (n_samples, n_features) nd arrays
+        source data of each piece
+    Ys: list of (n_samples, n_features) nd arrays
+        target data of each piece
+    scaling: bool
+        If scaling is true, computes a floating scaling parameter for each
+        piece (see scaled_procrustes). If scaling is false they are set to 1
+
+    Returns
+    ----------
+    Rs: list of (n_features, n_features) nd arrays
+        transformation matrices
+    scs: list of floats
+        scaling parameters
+    """
+    Rs, scs = [None] * len(Xs), [1] * len(Xs)
+    indices, X_stack, Y_stack, x_norms = [], [], [], []
+    for i, (X, Y) in enumerate(zip(Xs, Ys)):
+        X, Y, x_norm, solution = _prepare_procrustes(X, Y, scaling)
+        if solution is not None:
+            Rs[i], scs[i] = solution
+        else:
+            indices.append(i)
+            X_stack.append(X)
+            Y_stack.append(Y)
+            x_norms.append(x_norm)
+    if indices:
+        X, Y = np.stack(X_stack), np.stack(Y_stack)
+        U, s, V = np.linalg.svd(np.matmul(Y.swapaxes(1, 2), X),
+                                full_matrices=False)
+        R = np.matmul(U, V).swapaxes(1, 2)
+        for k, i in enumerate(indices):
+            Rs[i] = R[k]
+            scs[i] = _procrustes_scale(s[k], x_norms[k], scaling)
+    return Rs, scs
 
 
 def optimal_permutation(X, Y):
@@ -189,12 +322,17 @@ class ScaledOrthogonalAlignment(Alignment):
     ---------
     scaling : boolean, optional
         Determines whether a scaling parameter is applied to improve transform.
+    dtype : numpy dtype, optional (default = np.float64)
+        Precision in which the transform is estimated. np.float32 halves
+        memory usage and roughly doubles the speed of the SVD on large
+        regions, at the cost of a ~1e-6 relative error on R.
     R : ndarray (n_features, n_features)
         Optimal orthogonal transform
     """
 
-    def __init__(self, scaling=True):
+    def __init__(self, scaling=True, dtype=np.float64):
         self.scaling = scaling
+        self.dtype = dtype
         self.scale = 1
 
     def fit(self, X, Y):
@@ -205,6 +343,8 @@ class ScaledOrthogonalAlignment(Alignment):
         Y: (n_samples, n_features) nd array
             target data
         """
+        X = X.astype(self.dtype, copy=False)
+        Y = Y.astype(self.dtype, copy=False)
         R, sc = scaled_procrustes(X, Y, scaling=self.scaling)
         self.scale = sc
         self.R = sc * R
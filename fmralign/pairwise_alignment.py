@@ -3,18 +3,24 @@ import numpy as np
 from time import time
 
 from sklearn.base import BaseEstimator, TransformerMixin
-from joblib import Parallel, delayed
+from joblib import Parallel, delayed, effective_n_jobs
 from sklearn.externals.joblib import Memory
 from sklearn.model_selection import ShuffleSplit
 from nilearn.input_data.masker_validation import check_embedded_nifti_masker
 
 from fmralign.alignment_methods import RidgeAlignment, Identity, Hungarian, \
-    ScaledOrthogonalAlignment, OptimalTransportAlignment, DiagonalAlignment
+    ScaledOrthogonalAlignment, OptimalTransportAlignment, DiagonalAlignment, \
+    scaled_procrustes_batch
 from fmralign._utils import hierarchical_k_means, make_parcellation, \
     piecewise_transform, load_img
 
+# scaled orthogonal alignment batches the SVDs of pieces of identical size
+# with at most this many features: the batched call is only faster on
+# small pieces
+MAX_STACKED_FEATURES = 10
 
-def generate_Xi_Yi(labels, X, Y, verbose=0):
+
+def generate_Xi_Yi(labels, X, Y, verbose=0, pieces=None):
     """ Generate source and target data X_i and Y_i for each piece i.
 
     Parameters
@@ -27,6 +33,9 @@ def generate_Xi_Yi(labels, X, Y, verbose=0):
         Target data for piece i (shape : n_features, n_samples)
     verbose: integer, optional.
         Indicate the level of verbosity.
+    pieces: list of ints, optional
+        Labels of the pieces to generate. By default, all pieces are
+        generated.
     Yields
     -------
     X_i: ndarray
@@ -38,12 +47,14 @@ def generate_Xi_Yi(labels, X, Y, verbose=0):
     unique_labels, counts = np.unique(labels, return_counts=True)
     if verbose > 0:
         print(counts)
-    for k in range(len(unique_labels)):
-        label = unique_labels[k]
+    if pieces is None:
+        pieces = unique_labels
+    for k in range(len(pieces)):
+        label = pieces[k]
         i = label == labels
         if (k + 1) % 25 == 0 and verbose > 0:
             print("Fitting parcel: " + str(k + 1) +
-                  "/" + str(len(unique_labels)))
+                  "/" + str(len(pieces)))
         yield X[i], Y[i]
 
 
@@ -92,6 +103,68 @@ def fit_one_piece(X_i, Y_i, alignment_method):
     return alignment_algo
 
 
+def stackable_pieces(labels, n_samples, n_jobs=1):
+    """ Group the pieces which scaled orthogonal alignment fits by batches :
+    pieces of identical size, with at most MAX_STACKED_FEATURES features and
+    at least as many samples as features. Each group is split in up to
+    n_jobs stacks so that they can be fitted in parallel.
+
+    Parameters
+    ----------
+    labels : list of ints (len n_features)
+        Parcellation of features in clusters
+    n_samples: int
+        Number of samples in each piece
+    n_jobs: integer, optional
+        The number of CPUs to use to do the computation. -1 means
+        'all CPUs', -2 'all CPUs but one', and so on.
+
+    Returns
+    -------
+    stacks: list of lists of ints
+        Labels of the pieces in each stack
+    """
+    unique_labels, counts = np.unique(labels, return_counts=True)
+    groups = {}
+    for label, n_features in zip(unique_labels, counts):
+        if n_features <= MAX_STACKED_FEATURES and n_features <= n_samples:
+            groups.setdefault(n_features, []).append(label)
+    n_stacks = effective_n_jobs(n_jobs)
+    return [list(stack) for group in groups.values() if len(group) > 1
+            for stack in np.array_split(group, min(n_stacks, len(group)))]
+
+
+def fit_scaled_orthogonal_stack(X_is, Y_is):
+    """ Align source and target data with scaled orthogonal alignment in a
+    group of pieces of identical size, batching their SVDs.
+
+    Parameters
+    ----------
+    X_is: list of ndarrays
+        Source data for each piece i (shape : n_features_i, n_samples)
+    Y_is: list of ndarrays
+        Target data for each piece i (shape : n_features_i, n_samples)
+
+    Returns
+    -------
+    fit: list of ScaledOrthogonalAlignment
+        Instances of alignment estimator class fitted for each X_i, Y_i
+    """
+    default_algo = ScaledOrthogonalAlignment()
+    Rs, scs = scaled_procrustes_batch(
+        [X_i.T.astype(default_algo.dtype, copy=False) for X_i in X_is],
+        [Y_i.T.astype(default_algo.dtype, copy=False) for Y_i in Y_is],
+        scaling=default_algo.scaling)
+
+    fit = []
+    for R, sc in zip(Rs, scs):
+        alignment_algo = ScaledOrthogonalAlignment()
+        alignment_algo.scale = sc
+        alignment_algo.R = sc * R
+        fit.append(alignment_algo)
+    return fit
+
+
 def fit_one_parcellation(X_, Y_, alignment_method, mask, n_pieces,
                          clustering_method, clustering_index, mem,
                          n_jobs, parallel_backend, verbose):
@@ -141,11 +214,30 @@ def fit_one_parcellation(X_, Y_, alignment_method, mask, n_pieces,
     else:
         labels = np.zeros(int(mask.sum()), dtype=np.int8)
 
+    stacks = []
+    if alignment_method == 'scaled_orthogonal':
+        stacks = stackable_pieces(labels, X_.shape[1], n_jobs)
+    stacked = set(label for stack in stacks for label in stack)
+    unique_labels = np.unique(labels)
+    single_pieces = [label for label in unique_labels if label not in stacked]
+
     fit = Parallel(n_jobs, backend=parallel_backend, verbose=verbose)(
         delayed(fit_one_piece)(
             X_i, Y_i, alignment_method
-        ) for X_i, Y_i in generate_Xi_Yi(labels, X_, Y_, verbose)
+        ) for X_i, Y_i in generate_Xi_Yi(labels, X_, Y_, verbose,
+                                         single_pieces)
     )
+    if stacks:
+        stacked_fit = Parallel(
+            n_jobs, backend=parallel_backend, verbose=verbose)(
+            delayed(fit_scaled_orthogonal_stack)(
+                *zip(*generate_Xi_Yi(labels, X_, Y_, pieces=stack))
+            ) for stack in stacks
+        )
+        fitted = dict(zip(single_pieces, fit))
+        for stack, stack_fit in zip(stacks, stacked_fit):
+            fitted.update(zip(stack, stack_fit))
+        fit = [fitted[label] for label in unique_labels]
 
     return labels, fit
 
@@ -229,7 +321,9 @@ class PairwiseAlignment(BaseEstimator, TransformerMixin):
             'all CPUs', -2 'all CPUs but one', and so on.
         parallel_backend: str, ParallelBackendBase instance, None (default: 'threading')
             Specify the parallelization backend implementation. For more
-            informations see joblib.Parallel documentation
+            informations see joblib.Parallel documentation. It is used for
+            all alignment methods, including the stacks of small pieces
+            fitted by batches with 'scaled_orthogonal'.
         verbose: integer, optional (default = 0)
             Indicate the level of verbosity. By default, nothing is printed.
         """
@@ -296,28 +390,42 @@ class PairwiseAlignment(BaseEstimator, TransformerMixin):
 
         return self
 
-    def transform(self, X):
+    def transform(self, X, already_masked=False, return_masked=False):
         """Predict data from X
 
         Parameters
         ----------
-        X: Niimg-like object
+        X: Niimg-like object or ndarray
            See http://nilearn.github.io/manipulating_images/input_output.html
-           source data
+           source data. If already_masked is True, source data masked with
+           the mask of the estimator (shape : n_samples, n_features)
+        already_masked: boolean, optional (default = False)
+           Whether X has already been masked, in which case the masking
+           step is skipped.
+        return_masked: boolean, optional (default = False)
+           Whether to return the predicted data as a masked array instead
+           of an image, skipping the unmasking step.
 
         Returns
         -------
-        X_transform: Niimg-like object
+        X_transform: Niimg-like object or ndarray
            See http://nilearn.github.io/manipulating_images/input_output.html
-           predicted data
+           predicted data. If return_masked is True, predicted data masked
+           with the mask of the estimator (shape : n_samples, n_features)
         """
-        X_ = load_img(self.masker_, X)
+        if already_masked:
+            X_ = np.asarray(X).T
+        else:
+            X_ = load_img(self.masker_, X)
 
-        X_transform = np.zeros_like(X_)
-        for i in range(self.n_bags):
+        X_transform = piecewise_transform(self.labels_[0], self.fit_[0], X_)
+        for i in range(1, self.n_bags):
             X_transform += piecewise_transform(
                 self.labels_[i], self.fit_[i], X_)
 
-        X_transform /= self.n_bags
+        if self.n_bags > 1:
+            X_transform /= self.n_bags
 
+        if return_masked:
+            return X_transform.T
         return self.masker_.inverse_transform(X_transform.T)
@@ -1,36 +1,39 @@
 import numpy as np
-from sklearn.utils.testing import assert_array_almost_equal, assert_greater
+from sklearn.utils.testing import assert_array_almost_equal, assert_greater, \
+    assert_raises
 from scipy.linalg import orthogonal_procrustes
 from fmralign.alignment_methods import scaled_procrustes, \
-    optimal_permutation, _voxelwise_signal_projection
+    scaled_procrustes_batch, optimal_permutation, _voxelwise_signal_projection
 from fmralign.alignment_methods import Identity, DiagonalAlignment, Hungarian,\
     ScaledOrthogonalAlignment, RidgeAlignment, OptimalTransportAlignment
 from fmralign.tests.utils import assert_class_align_better_than_identity, \
-    zero_mean_coefficient_determination
+    zero_mean_coefficient_determination, center_rows
+
+rng = np.random.RandomState(0)
 
 
 def test_scaled_procrustes_algorithmic():
     '''Test Scaled procrustes'''
-    X = np.random.randn(10, 20)
+    X = rng.standard_normal((10, 20))
     Y = np.zeros_like(X)
     R = np.eye(X.shape[1])
     R_test, _ = scaled_procrustes(X, Y)
-    assert_array_almost_equal(R, R_test.toarray())
+    assert_array_almost_equal(R, R_test)
 
     '''Test if scaled_procrustes basis is orthogonal'''
-    X = np.random.rand(3, 4)
-    X = X - X.mean(axis=1, keepdims=True)
+    X = rng.random_sample((3, 4))
+    X = center_rows(X, out=X)
 
-    Y = np.random.rand(3, 4)
-    Y = Y - Y.mean(axis=1, keepdims=True)
+    Y = rng.random_sample((3, 4))
+    Y = center_rows(Y, out=Y)
 
     R, _ = scaled_procrustes(X.T, Y.T)
     assert_array_almost_equal(R.dot(R.T), np.eye(R.shape[0]))
     assert_array_almost_equal(R.T.dot(R), np.eye(R.shape[0]))
 
     ''' Test if it sticks to scipy scaled procrustes in a simple case'''
-    X = np.random.rand(4, 4)
-    Y = np.random.rand(4, 4)
+    X = rng.random_sample((4, 4))
+    Y = rng.random_sample((4, 4))
 
     R, _ = scaled_procrustes(X, Y)
     R_s, _ = orthogonal_procrustes(Y, X)
@@ -39,30 +42,111 @@ def test_scaled_procrustes_algorithmic():
     '''Test that primal and dual give same results'''
     # number of samples n , number of voxels p
     n, p = 100, 20
-    X = np.random.randn(n, p)
-    Y = np.random.randn(n, p)
+    X = rng.standard_normal((n, p))
+    Y = rng.standard_normal((n, p))
     R1, s1 = scaled_procrustes(X, Y, scaling=True, primal=True)
     R_s, _ = orthogonal_procrustes(Y, X)
     R2, s2 = scaled_procrustes(X, Y, scaling=True, primal=False)
     assert_array_almost_equal(R1, R2)
     assert_array_almost_equal(R2, R_s.T)
     n, p = 20, 100
-    X = np.random.randn(n, p)
-    Y = np.random.randn(n, p)
+    X = rng.standard_normal((n, p))
+    Y = rng.standard_normal((n, p))
     R1, s1 = scaled_procrustes(X, Y, scaling=True, primal=True)
     R_s, _ = orthogonal_procrustes(Y, X)
     R2, s2 = scaled_procrustes(X, Y, scaling=True, primal=False)
     assert_array_almost_equal(s1 * X.dot(R1), s2 * X.dot(R2))
 
 
+def test_scaled_procrustes_non_finite_input():
+    '''Test that infs and NaNs are rejected before reaching LAPACK'''
+    for n_samples, n_features in [(10, 30), (30, 10)]:
+        X = rng.standard_normal((n_samples, n_features))
+        Y = rng.standard_normal((n_samples, n_features))
+        for value in [np.inf, np.nan]:
+            X_bad = X.copy()
+            X_bad[2, 3] = value
+            assert_raises(ValueError, scaled_procrustes, X_bad, Y)
+            assert_raises(ValueError, scaled_procrustes, Y, X_bad)
+
+
+def test_scaled_procrustes_primal_dual_dispatch():
+    '''Test that the default path is chosen after the shape of the data'''
+    # more samples than voxels: primal
+    n, p = 100, 20
+    X = rng.standard_normal((n, p))
+    Y = rng.standard_normal((n, p))
+    R, s = scaled_procrustes(X, Y, scaling=True)
+    R1, s1 = scaled_procrustes(X, Y, scaling=True, primal=True)
+    assert_array_almost_equal(R, R1)
+    assert_array_almost_equal(s, s1)
+    # more voxels than samples: dual
+    n, p = 20, 100
+    X = rng.standard_normal((n, p))
+    Y = rng.standard_normal((n, p))
+    R, s = scaled_procrustes(X, Y, scaling=True)
+    R2, s2 = scaled_procrustes(X, Y, scaling=True, primal=False)
+    assert_array_almost_equal(R, R2)
+    assert_array_almost_equal(s, s2)
+    R1, s1 = scaled_procrustes(X, Y, scaling=True, primal=True)
+    assert_array_almost_equal(s * X.dot(R), s1 * X.dot(R1))
+
+
+def test_scaled_procrustes_proportional_inputs():
+    '''Test the shortcut taken when Y is a multiple of X'''
+    X = rng.standard_normal((100, 20))
+    R, sc = scaled_procrustes(X, 3 * X, scaling=True)
+    assert_array_almost_equal(R, np.eye(20))
+    assert_array_almost_equal(sc, 3)
+    R, sc = scaled_procrustes(X, 3 * X, scaling=False)
+    assert_array_almost_equal(R, np.eye(20))
+    assert sc == 1
+    # nearly proportional inputs, here a small rotation of X, must not be
+    # snapped to the identity
+    Q, S = np.linalg.qr(np.eye(20) + 1.e-6 * rng.standard_normal((20, 20)))
+    Q *= np.sign(np.diag(S))
+    R, _ = scaled_procrustes(X, X.dot(Q))
+    assert not np.array_equal(R, np.eye(20))
+    assert_array_almost_equal(R, Q, decimal=12)
+    # same in single precision
+    X = rng.standard_normal((100, 20)).astype(np.float32)
+    R, sc = scaled_procrustes(X, 3 * X, scaling=True)
+    assert R.dtype == np.float32
+    assert_array_almost_equal(R, np.eye(20))
+    assert_array_almost_equal(sc, 3)
+    for _ in range(20):
+        X = rng.standard_normal((100, 20)).astype(np.float32)
+        Y = X + 3.e-5 * rng.standard_normal((100, 20)).astype(np.float32)
+        R, _ = scaled_procrustes(X, Y)
+        R_test, _ = scaled_procrustes(X.astype(np.float64),
+                                      Y.astype(np.float64))
+        assert not np.array_equal(R, np.eye(20))
+        assert_array_almost_equal(R, R_test, decimal=5)
+
+
+def test_scaled_procrustes_batch():
+    '''Test that batched procrustes matches one call per piece'''
+    Xs = [rng.standard_normal((30, 5)) for _ in range(4)]
+    Ys = [rng.standard_normal((30, 5)) for _ in range(4)]
+    Ys[2] = np.zeros((30, 5))
+    Ys[3] = 2 * Xs[3]
+    Rs, scs = scaled_procrustes_batch(Xs, Ys, scaling=True)
+    for X, Y, R, sc in zip(Xs, Ys, Rs, scs):
+        R_test, sc_test = scaled_procrustes(X, Y, scaling=True)
+        assert_array_almost_equal(R, R_test)
+        assert_array_almost_equal(sc, sc_test)
+    assert_array_almost_equal(Rs[2], np.eye(5))
+    assert scs[2] == 1
+
+
 def test_scaled_procrustes_on_simple_exact_cases():
     '''Orthogonal Matrix'''
     v = 10
     k = 10
-    rnd_matrix = np.random.rand(v, k)
+    rnd_matrix = rng.random_sample((v, k))
     R, _ = np.linalg.qr(rnd_matrix)
-    X = np.random.rand(10, 20)
-    X = X - X.mean(axis=1, keepdims=True)
+    X = rng.random_sample((10, 20))
+    X = center_rows(X, out=X)
     Y = R.dot(X)
     R_test, _ = scaled_procrustes(X.T, Y.T)
     assert_array_almost_equal(R_test.T, R)
@@ -72,10 +156,10 @@ def test_scaled_procrustes_on_simple_exact_cases():
                   [5., 3., 4., 6.],
                   [7., 8., -5., -2.]])
 
-    X = X - X.mean(axis=1, keepdims=True)
+    X = center_rows(X, out=X)
 
     Y = 2 * X
-    Y = Y - Y.mean(axis=1, keepdims=True)
+    Y = center_rows(Y, out=Y)
 
     assert_array_almost_equal(
         scaled_procrustes(X.T, Y.T, scaling=True)[0], np.eye(3))
@@ -84,8 +168,8 @@ def test_scaled_procrustes_on_simple_exact_cases():
     '''3D Rotation'''
     R = np.array([[1., 0., 0.], [0., np.cos(1), -np.sin(1)],
                   [0., np.sin(1), np.cos(1)]])
-    X = np.random.rand(3, 4)
-    X = X - X.mean(axis=1, keepdims=True)
+    X = rng.random_sample((3, 4))
+    X = center_rows(X, out=X)
     Y = R.dot(X)
 
     R_test, _ = scaled_procrustes(X.T, Y.T)
@@ -107,6 +191,17 @@ def test_scaled_procrustes_on_simple_exact_cases():
         Y.T)
 
 
+def test_scaled_orthogonal_alignment_single_precision():
+    '''Test that float32 estimation stays close to the float64 one'''
+    X = rng.standard_normal((100, 20))
+    Y = rng.standard_normal((100, 20))
+    ortho_al = ScaledOrthogonalAlignment().fit(X, Y)
+    ortho_al_32 = ScaledOrthogonalAlignment(dtype=np.float32).fit(X, Y)
+    assert ortho_al.R.dtype == np.float64
+    assert ortho_al_32.R.dtype == np.float32
+    assert_array_almost_equal(ortho_al.R, ortho_al_32.R, decimal=4)
+
+
 def test_optimal_permutation_on_translation_case():
     ''' Test optimal permutation method'''
     X = np.array([[1., 4., 10], [1.5, 5, 10], [1, 5, 11], [1, 5.5, 8]]).T
@@ -126,7 +221,7 @@ def test_optimal_permutation_on_translation_case():
 def test_projection_coefficients():
     n_samples = 4
     n_features = 6
-    A = np.random.rand(n_samples, n_features)
+    A = rng.random_sample((n_samples, n_features))
     C = []
     for i, a in enumerate(A):
         C.append((i + 1) * a)
@@ -139,8 +234,8 @@ def test_all_classes_R_and_pred_shape_and_better_than_identity():
     '''Test all classes on random case'''
 
     for n_samples, n_features in [(100, 20), (20, 100)]:
-        X = np.random.randn(n_samples, n_features)
-        Y = np.random.randn(n_samples, n_features)
+        X = rng.standard_normal((n_samples, n_features))
+        Y = rng.standard_normal((n_samples, n_features))
         id = Identity()
         id.fit(X, Y)
         identity_baseline_score = zero_mean_coefficient_determination(Y, X)
@@ -7,7 +7,8 @@ from fmralign.pairwise_alignment import PairwiseAlignment
 from fmralign.tests.utils import assert_algo_transform_almost_exactly, \
     random_niimg, assert_model_align_better_than_identity, \
     zero_mean_coefficient_determination
-from fmralign.alignment_methods import optimal_permutation, Hungarian
+from fmralign.alignment_methods import optimal_permutation, Hungarian, \
+    ScaledOrthogonalAlignment
 
 
 def test_pairwise_identity():
@@ -49,3 +50,41 @@ def test_models_against_identity():
                                                          masker.transform(
                                                              im_test))
         assert_greater(algo_score, identity_baseline_score)
+
+
+def test_scaled_orthogonal_stacked_pieces():
+    '''Test that batching small pieces matches fitting them one by one'''
+    img1, mask_img = random_niimg((4, 4, 4, 20))
+    img2, _ = random_niimg((4, 4, 4, 20))
+    masker = NiftiMasker(mask_img=mask_img)
+    masker.fit()
+    stacked = PairwiseAlignment(alignment_method='scaled_orthogonal',
+                                mask=mask_img, n_pieces=16)
+    one_by_one = PairwiseAlignment(
+        alignment_method=ScaledOrthogonalAlignment(), mask=mask_img,
+        n_pieces=16)
+    one_by_one.fit(img1, img2)
+    expected = masker.transform(one_by_one.transform(img1))
+    for n_jobs, parallel_backend in [(1, 'threading'),
+                                     (2, 'multiprocessing')]:
+        stacked.set_params(n_jobs=n_jobs, parallel_backend=parallel_backend)
+        stacked.fit(img1, img2)
+        assert_array_almost_equal(
+            masker.transform(stacked.transform(img1)), expected)
+
+
+def test_transform_masked_input_and_output():
+    img1, mask_img = random_niimg((7, 6, 8, 5))
+    img2, _ = random_niimg((7, 6, 8, 5))
+    masker = NiftiMasker(mask_img=mask_img)
+    masker.fit()
+    algo = PairwiseAlignment(alignment_method='scaled_orthogonal',
+                             mask=mask_img, n_pieces=2)
+    algo.fit(img1, img2)
+    im_test = algo.transform(img1)
+    im_test_masked = algo.transform(masker.transform(img1),
+                                    already_masked=True)
+    assert_array_almost_equal(masker.transform(im_test),
+                              masker.transform(im_test_masked))
+    X_transform = algo.transform(img1, return_masked=True)
+    assert_array_almost_equal(masker.transform(im_test), X_transform)
@@ -17,6 +17,15 @@ def assert_class_align_better_than_identity(algo, X, Y):
     assert_greater(algo_score, identity_baseline_score)
 
 
+def center_rows(X, out=None):
+    """ Remove from each row of X its mean. The result is written in out if \
+    given (out=X centers X in place), in a new array otherwise.
+    """
+    if out is None:
+        out = np.empty_like(X)
+    return np.subtract(X, X.mean(axis=1, keepdims=True), out=out)
+
+
 def assert_algo_transform_almost_exactly(algo, img1, img2, mask=None):
     """ Tests that the given algorithm manage to transform almost exactly Nifti\
      image img1 into Nifti Image img2
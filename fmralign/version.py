@@ -34,7 +34,7 @@ REQUIRED_MODULE_METADATA = (
         'required_at_installation': True,
         'install_info': _FMRALIGN_INSTALL_MSG}),
     ('scipy', {
-        'min_version': '0.17',
+        'min_version': '0.18',
         'required_at_installation': True,
         'install_info': _FMRALIGN_INSTALL_MSG}),
     ('sklearn', {